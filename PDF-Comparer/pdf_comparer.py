@@ -1,28 +1,40 @@
 import fitz
-from PIL import Image, ImageDraw
-import difflib
+from rapidfuzz import fuzz
 import re
 import os
 import argparse
-from typing import List, Tuple, Dict, Set
-from dataclasses import dataclass
+from typing import List, Tuple, Dict, NamedTuple, Optional
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
-@dataclass
-class TextBlock:
-    """Data class to store text block information with enhanced attributes"""
+# Expand ligatures like the default text page does so ligature glyphs match plain letters
+TEXT_EXTRACTION_FLAGS = fitz.TEXTFLAGS_DICT & ~(fitz.TEXT_PRESERVE_IMAGES | fitz.TEXT_PRESERVE_LIGATURES)
+DEFAULT_NUM_WORKERS = min(os.cpu_count() or 1, 4)
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+class TextBlock(NamedTuple):
+    """Named tuple to store text block information with enhanced attributes"""
     bbox: Tuple[float, float, float, float]
     text: str
     page: int
     font: str = ""
     size: float = 0
-    color: Tuple[float, float, float] = (0, 0, 0)
+    color: int = 0
+    normalized: str = ""
+
+def _reading_order_key(block: TextBlock) -> Tuple[float, float]:
+    """Sort key ordering blocks top-to-bottom, then left-to-right"""
+    bbox = block.bbox
+    return (bbox[1], bbox[0])
 
 class PDFComparer:
     def __init__(self, 
                  similarity_threshold: float = 0.8,
                  position_threshold: float = 5.0,
-                 check_formatting: bool = True):
+                 check_formatting: bool = True,
+                 num_workers: int = DEFAULT_NUM_WORKERS,
+                 render_scale: float = 2.0):
         """
         Initialize PDF comparer with enhanced configuration
         
@@ -30,91 +42,126 @@ class PDFComparer:
             similarity_threshold: Float between 0 and 1, higher means more similar text
             position_threshold: Maximum allowed position difference in points
             check_formatting: Whether to check formatting changes (font, size, color)
+            num_workers: Number of processes used for page extraction and rendering
+            render_scale: Zoom factor used when rendering pages with differences to PNG
         """
         self.similarity_threshold = similarity_threshold
         self.position_threshold = position_threshold
         self.check_formatting = check_formatting
+        if num_workers < 1:
+            raise ValueError(f"num_workers must be at least 1, got {num_workers}")
+        self.num_workers = num_workers
+        if render_scale <= 0:
+            raise ValueError(f"render_scale must be positive, got {render_scale}")
+        self.render_scale = render_scale
 
     # [Previous methods remain unchanged...]
-    def get_color_tuple(self, span: dict) -> Tuple[float, float, float]:
+    def get_color(self, span: dict) -> int:
+        """
+        Extract span color packed as a 0xRRGGBB integer
+        """
+        color = span.get("color", 0)
+        # PyMuPDF reports span colors as packed sRGB integers already
+        if type(color) is int:
+            return color
+        # Handle tuple/list color values with float components in 0..1
+        if isinstance(color, (tuple, list)) and len(color) >= 3:
+            r, g, b = (int(round(float(c) * 255)) for c in color[:3])
+            return (r << 16) | (g << 8) | b
+        return 0
+
+    def extract_page_blocks(self, page: fitz.Page, page_num: int) -> List[TextBlock]:
+        """
+        Extract text blocks with positioning and formatting information from a single page
+        """
+        page_blocks = []
+        append_block = page_blocks.append
+        get_color = self.get_color
+        normalize_text = self.normalize_text
+        
+        # Get detailed text information including formatting
+        text_dict = page.get_text("dict", flags=TEXT_EXTRACTION_FLAGS)
+        
+        for block in text_dict["blocks"]:
+            if block.get("type", 0) != 0:
+                continue
+            for line in block["lines"]:
+                for span in line["spans"]:
+                    text = span["text"].strip()
+                    if text:
+                        # PyMuPDF always fills in bbox, font and size for text spans
+                        append_block(TextBlock(
+                            tuple(span["bbox"]),
+                            text,
+                            page_num,
+                            span["font"],
+                            float(span["size"]),
+                            get_color(span),
+                            normalize_text(text)
+                        ))
+        
+        # Sort blocks by vertical position for more accurate comparison
+        page_blocks.sort(key=_reading_order_key)
+        return page_blocks
+
+    def map_pages(self, worker, pdf_path: str, page_nums: List[int], *args) -> list:
         """
-        Safely extract color information from span
+        Run worker over contiguous chunks of pages, in worker processes when more than one is configured
         """
-        try:
-            color = span.get("color", 0)
-            # Handle integer color values
-            if isinstance(color, int):
-                # Convert to RGB tuple (assuming black if 0)
-                return (0, 0, 0)
-            # Handle tuple/list color values
-            elif isinstance(color, (tuple, list)):
-                return tuple(float(c) for c in color[:3])
-            else:
-                return (0, 0, 0)
-        except:
-            return (0, 0, 0)
+        num_chunks = max(1, min(self.num_workers, len(page_nums)))
+        chunk_size = -(-len(page_nums) // num_chunks) if page_nums else 1
+        chunks = [page_nums[i:i + chunk_size] for i in range(0, len(page_nums), chunk_size)]
+        
+        if len(chunks) <= 1:
+            results = [worker(self, pdf_path, chunk, *args) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+                results = list(executor.map(
+                    worker, repeat(self), repeat(pdf_path), chunks,
+                    *(repeat(arg) for arg in args)
+                ))
+        
+        return [item for chunk_result in results for item in chunk_result]
 
     def get_text_blocks(self, pdf_path: str) -> Dict[int, List[TextBlock]]:
         """
         Extract text blocks with enhanced positioning and formatting information
         """
-        doc = fitz.open(pdf_path)
-        pages_blocks = defaultdict(list)
-        
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            
-            # Get detailed text information including formatting
-            text_page = page.get_textpage()
-            text_dict = text_page.extractDICT()
-            
-            for block in text_dict["blocks"]:
-                for line in block["lines"]:
-                    for span in line["spans"]:
-                        text = span["text"].strip()
-                        if text:
-                            bbox = tuple(span["bbox"])
-                            # Extract formatting information safely
-                            font = span.get("font", "")
-                            size = float(span.get("size", 0))
-                            color = self.get_color_tuple(span)
-                            
-                            text_block = TextBlock(
-                                bbox=bbox,
-                                text=text,
-                                page=page_num,
-                                font=font,
-                                size=size,
-                                color=color
-                            )
-                            pages_blocks[page_num].append(text_block)
-            
-            # Sort blocks by vertical position for more accurate comparison
-            pages_blocks[page_num].sort(key=lambda x: (x.bbox[1], x.bbox[0]))
+        with fitz.open(pdf_path) as doc:
+            page_count = len(doc)
         
-        doc.close()
+        pages_blocks = self.map_pages(_extract_pages, pdf_path, list(range(page_count)))
         return dict(pages_blocks)
 
+    def normalize_text(self, text: str) -> str:
+        """
+        Normalize text for comparison by lowercasing and collapsing whitespace
+        """
+        return WHITESPACE_PATTERN.sub(' ', text.lower().strip())
+
     def calculate_text_similarity(self, text1: str, text2: str) -> float:
         """
-        Calculate similarity ratio between two text strings with improved accuracy
+        Calculate similarity ratio between two normalized text strings
         """
-        text1 = re.sub(r'\s+', ' ', text1.lower().strip())
-        text2 = re.sub(r'\s+', ' ', text2.lower().strip())
+        if text1 == text2:
+            return 1.0
         
-        sequence_matcher = difflib.SequenceMatcher(None, text1, text2)
-        return sequence_matcher.ratio()
+        # Scores below the threshold are only ever compared against it, so let
+        # rapidfuzz bail out early and report them as 0
+        return fuzz.ratio(text1, text2, score_cutoff=self.similarity_threshold * 100) / 100
 
-    def blocks_are_similar(self, block1: TextBlock, block2: TextBlock) -> bool:
+    def block_similarity(self, block1: TextBlock, block2: TextBlock) -> Optional[float]:
         """
-        Compare two blocks considering both content and positioning
+        Score two blocks by text similarity, or None if their position or formatting differ
         """
-        text_similar = self.calculate_text_similarity(block1.text, block2.text) >= self.similarity_threshold
-        
-        position_similar = all(
-            abs(b1 - b2) <= self.position_threshold
-            for b1, b2 in zip(block1.bbox, block2.bbox)
-        )
+        # Run the cheap numeric checks first so only blocks that already line up
+        # in position and formatting pay for the text similarity computation
+        x0a, y0a, x1a, y1a = block1.bbox
+        x0b, y0b, x1b, y1b = block2.bbox
+        threshold = self.position_threshold
+        if (abs(x0a - x0b) > threshold or abs(y0a - y0b) > threshold or
+                abs(x1a - x1b) > threshold or abs(y1a - y1b) > threshold):
+            return None
         
         if self.check_formatting:
             formatting_similar = (
@@ -122,9 +169,45 @@ class PDFComparer:
                 abs(block1.size - block2.size) < 0.1 and
                 block1.color == block2.color
             )
-            return text_similar and position_similar and formatting_similar
+            if not formatting_similar:
+                return None
         
-        return text_similar and position_similar
+        # Blocks built outside extract_page_blocks may not carry normalized text
+        text1 = block1.normalized or self.normalize_text(block1.text)
+        text2 = block2.normalized or self.normalize_text(block2.text)
+        return self.calculate_text_similarity(text1, text2)
+
+    def blocks_are_similar(self, block1: TextBlock, block2: TextBlock) -> bool:
+        """
+        Compare two blocks considering both content and positioning
+        """
+        score = self.block_similarity(block1, block2)
+        return score is not None and score >= self.similarity_threshold
+
+    def build_position_index(self, blocks: List[TextBlock]) -> Dict[Tuple[int, int], List[int]]:
+        """
+        Bucket blocks into a grid of position_threshold-sized cells keyed by their top-left corner
+        """
+        cell_size = self.position_threshold or 1.0
+        index = defaultdict(list)
+        for i, block in enumerate(blocks):
+            index[(int(block.bbox[0] // cell_size), int(block.bbox[1] // cell_size))].append(i)
+        return index
+
+    def position_candidates(self, index: Dict[Tuple[int, int], List[int]],
+                            block: TextBlock) -> List[int]:
+        """
+        Return indices of indexed blocks that may lie within position_threshold of block
+        """
+        cell_size = self.position_threshold or 1.0
+        cx = int(block.bbox[0] // cell_size)
+        cy = int(block.bbox[1] // cell_size)
+        candidates = []
+        get_cell = index.get
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                candidates.extend(get_cell((cx + dx, cy + dy), ()))
+        return candidates
 
     def find_differences(self, original_blocks: Dict[int, List[TextBlock]], 
                         modified_blocks: Dict[int, List[TextBlock]]) -> List[TextBlock]:
@@ -132,7 +215,9 @@ class PDFComparer:
         Find differences between original and modified PDFs with comprehensive checking
         """
         differences = []
-        processed_pages = set()
+        similarity_threshold = self.similarity_threshold
+        block_similarity = self.block_similarity
+        position_candidates = self.position_candidates
         
         all_pages = set(original_blocks.keys()) | set(modified_blocks.keys())
         
@@ -145,80 +230,108 @@ class PDFComparer:
                 continue
             if not mod_page_blocks:
                 continue  
+            # Unchanged pages are the common case; identical block lists can't
+            # contain differences, so skip matching them altogether
+            if orig_page_blocks == mod_page_blocks:
+                continue
                 
-            unmatched_orig = set(range(len(orig_page_blocks)))
-            unmatched_mod = set(range(len(mod_page_blocks)))
+            # Only blocks in neighbouring grid cells can pass the position check
+            position_index = self.build_position_index(orig_page_blocks)
             
-            for i in list(unmatched_mod):
-                mod_block = mod_page_blocks[i]
-                
-                for j in list(unmatched_orig):
-                    orig_block = orig_page_blocks[j]
-                    
-                    if self.blocks_are_similar(mod_block, orig_block):
-                        unmatched_mod.remove(i)
-                        unmatched_orig.remove(j)
-                        break
+            candidate_pairs = []
+            for i, mod_block in enumerate(mod_page_blocks):
+                for j in position_candidates(position_index, mod_block):
+                    score = block_similarity(mod_block, orig_page_blocks[j])
+                    if score is not None and score >= similarity_threshold:
+                        candidate_pairs.append((-score, i, j))
+            
+            # Scores are negated so a plain sort claims the best pairs first and a weaker
+            # earlier match can't take the original another block matches exactly
+            candidate_pairs.sort()
             
-            differences.extend(mod_page_blocks[i] for i in unmatched_mod)
+            matched_orig = [False] * len(orig_page_blocks)
+            matched_mod = [False] * len(mod_page_blocks)
+            for _, i, j in candidate_pairs:
+                if matched_mod[i] or matched_orig[j]:
+                    continue
+                matched_mod[i] = True
+                matched_orig[j] = True
             
-            processed_pages.add(page_num)
+            differences.extend(
+                block for block, matched in zip(mod_page_blocks, matched_mod) if not matched
+            )
         
         return differences
 
+    def render_page_differences(self, page: fitz.Page,
+                                differences: List[TextBlock]) -> fitz.Pixmap:
+        """
+        Render a single page with its differences highlighted
+        """
+        # Draw the highlights in PDF space so the page only has to be rasterized once
+        for diff in differences:
+            page.draw_rect(
+                fitz.Rect(diff.bbox),
+                color=(1, 0, 0),  # Red border
+                fill=(1, 1, 0),  # Semi-transparent yellow
+                fill_opacity=0.3,
+                width=1
+            )
+        
+        return page.get_pixmap(matrix=fitz.Matrix(self.render_scale, self.render_scale))
+
+    def save_page_differences(self, pix: fitz.Pixmap, page_num: int, output_dir: str) -> None:
+        """
+        Encode a rendered page as PNG and write it to the output directory
+        """
+        output_path = os.path.join(output_dir, f"page_{page_num + 1}_differences.png")
+        pix.save(output_path)
+        print(f"Saved highlighted differences for page {page_num + 1}")
+
     def highlight_differences(self, pdf_path: str, differences: List[TextBlock], 
                             output_dir: str) -> None:
         """
         Create accurate highlighting of differences, skipping pages with no changes
         """
         os.makedirs(output_dir, exist_ok=True)
-        doc = fitz.open(pdf_path)
         
         page_differences = defaultdict(list)
         for diff in differences:
             page_differences[diff.page].append(diff)
         
         # Process only pages with differences
-        pages_with_changes = page_differences.keys()
+        pages_with_changes = sorted(page_differences.keys())
         if pages_with_changes:
             print(f"Processing {len(pages_with_changes)} pages with changes...")
-            
-            for page_num in range(len(doc)):
-                if page_num not in page_differences:
-                    continue  
-                    
-                page = doc[page_num]
-                pix = page.get_pixmap(matrix=fitz.Matrix(3, 3)) 
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                img = img.convert('RGBA')
-                
-                highlight_layer = Image.new('RGBA', img.size, (0, 0, 0, 0))
-                draw = ImageDraw.Draw(highlight_layer)
-                
-                scale = 3 
-                
-                for diff in page_differences[page_num]:
-                    x0, y0, x1, y1 = [coord * scale for coord in diff.bbox]
-                    
-                    draw.rectangle(
-                        [x0, y0, x1, y1],
-                        fill=(255, 255, 0, 80),  # Semi-transparent yellow
-                        outline=(255, 0, 0, 255),  # Red border
-                        width=3
-                    )
-                
-                img = Image.alpha_composite(img, highlight_layer)
-                
-                output_path = os.path.join(output_dir, f"page_{page_num + 1}_differences.png")
-                img.convert('RGB').save(output_path, 'PNG', quality=95)
-                print(f"Saved highlighted differences for page {page_num + 1}")
-        
-        doc.close()
+            self.map_pages(_render_pages, pdf_path, pages_with_changes,
+                           dict(page_differences), output_dir)
+
+def _extract_pages(comparer: PDFComparer, pdf_path: str,
+                   page_nums: List[int]) -> List[Tuple[int, List[TextBlock]]]:
+    """
+    Worker that extracts text blocks for a chunk of pages of one PDF
+    """
+    with fitz.open(pdf_path) as doc:
+        return [(page_num, comparer.extract_page_blocks(doc[page_num], page_num))
+                for page_num in page_nums]
+
+def _render_pages(comparer: PDFComparer, pdf_path: str, page_nums: List[int],
+                  page_differences: Dict[int, List[TextBlock]], output_dir: str) -> List[int]:
+    """
+    Worker that renders highlighted difference images for a chunk of pages of one PDF
+    """
+    with fitz.open(pdf_path) as doc:
+        for page_num in page_nums:
+            pix = comparer.render_page_differences(doc[page_num], page_differences[page_num])
+            comparer.save_page_differences(pix, page_num, output_dir)
+    return page_nums
 
 def compare_pdfs(original_path: str, modified_path: str, output_dir: str,
                 similarity_threshold: float = 0.8,
                 position_threshold: float = 5.0,
-                check_formatting: bool = True):
+                check_formatting: bool = True,
+                num_workers: int = DEFAULT_NUM_WORKERS,
+                render_scale: float = 2.0):
     """
     Main function to compare PDFs with enhanced configuration options
     """
@@ -226,7 +339,9 @@ def compare_pdfs(original_path: str, modified_path: str, output_dir: str,
         comparer = PDFComparer(
             similarity_threshold=similarity_threshold,
             position_threshold=position_threshold,
-            check_formatting=check_formatting
+            check_formatting=check_formatting,
+            num_workers=num_workers,
+            render_scale=render_scale
         )
         
         print("Extracting text from original PDF...")
@@ -267,6 +382,10 @@ def parse_arguments():
                         help='Position threshold in points (default: 5.0)')
     parser.add_argument('--ignore-formatting', action='store_true',
                         help='Ignore formatting changes (font, size, color)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_NUM_WORKERS,
+                        help='Number of worker processes (default: min(CPU count, 4))')
+    parser.add_argument('--scale', type=float, default=2.0,
+                        help='Render zoom factor for output images (default: 2.0)')
     
     return parser.parse_args()
 
@@ -284,5 +403,7 @@ if __name__ == "__main__":
         args.output_dir,
         similarity_threshold=args.similarity,
         position_threshold=args.position,
-        check_formatting=not args.ignore_formatting
+        check_formatting=not args.ignore_formatting,
+        num_workers=args.workers,
+        render_scale=args.scale
     )
\ No newline at end of file